@@ -59,6 +59,95 @@ True
 >>> len(list(tree.intersection(noverlap))) == 0
 True
 
+Large or sparse shapes can be split into several tighter boxes
+
+>>> lshape = "POLYGON((0 0, 10 0, 10 1, 1 1, 1 10, 0 10, 0 0))"
+>>> lshape = ogr.CreateGeometryFromWkt(lshape)
+>>> len(decompose(lshape, 1))
+3
+>>> tree = LinkedRtree(decompose_depth=2, hulls=True)
+>>> tree.addNQ(StringIO(text))
+>>> len(list(tree.intersection(overlap))) == 1
+True
+>>> len(list(tree.intersection(noverlap))) == 0
+True
+
+Replacing a resource removes all of its old entries from the R-tree,
+whether or not it was decomposed before
+
+>>> ex3 = '''
+... @prefix ogs: <http://www.opengis.net/ont/OGC-GeoSPARQL/1.0/>.
+... @prefix ogt: <http://www.opengis.net/def/dataType/OGC-SF/1.0/>.
+...
+... <http://example.org/baz> ogs:asWKT ""\"<http://www.opengis.net/def/crs/OGC/1.3/CRS84> POLYGON((-83.6 34.1, -83.2 34.1, -83.2 34.5, -83.6 34.5, -83.6 34.1))""\"^^ogt:WKTLiteral.
+... '''
+>>> def ingest(tree, uri, data):
+...     g = Graph(identifier=URIRef(uri))
+...     g.parse(StringIO(data), format="n3")
+...     text = ConjunctiveGraph(g.store).serialize(format="nquads")
+...     tree.addNQ(StringIO(text))
+...
+>>> everywhere = [-180, 180, -90, 90]
+>>> tree = LinkedRtree()
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> tree.count(everywhere)
+1
+>>> tree.decompose_depth, tree.decompose_extent = 2, 0.1
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> pieces = tree.count(everywhere)
+>>> pieces > 1
+True
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> tree.count(everywhere) == pieces
+True
+>>> tree.decompose_depth = 0
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> tree.count(everywhere)
+1
+
+A self-intersecting polygon that GEOS may refuse to clip still gets
+entries in the R-tree and can still be found
+
+>>> bowtie = ogr.CreateGeometryFromWkt("POLYGON((0 0, 10 10, 10 0, 0 10, 0 0))")
+>>> len(decompose(bowtie, 2)) > 0
+True
+>>> ex4 = ex3.replace("POLYGON((-83.6 34.1, -83.2 34.1, -83.2 34.5, -83.6 34.5, -83.6 34.1))",
+...                   "POLYGON((0 0, 10 10, 10 0, 0 10, 0 0))")
+>>> tree = LinkedRtree(decompose_depth=2)
+>>> ingest(tree, "http://example.org/ex4", ex4)
+>>> tree.count(everywhere) > 0
+True
+>>> len(list(tree.intersection(ogr.CreateGeometryFromWkt("POINT(2 5)").Buffer(0.1))))
+1
+
+Nearby pieces of one geometry count once towards the limit of nearest
+
+>>> pt = '''
+... @prefix wgs84: <http://www.w3.org/2003/01/geo/wgs84_pos#>.
+... <%s> wgs84:lat "%s"; wgs84:long "%s".
+... '''
+>>> tree = LinkedRtree(decompose_depth=2, decompose_extent=0.1)
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> for i, lng in enumerate(["-83.0", "-82.9"]):
+...     uri = "http://example.org/p%d" % i
+...     ingest(tree, uri, pt % (uri, "34.3", lng))
+...
+>>> centre = ogr.CreateGeometryFromWkt("POINT(-83.1 34.3)")
+>>> len(list(tree.nearest(centre, 3)))
+3
+
+The convex hull can accept a candidate for contains without the
+exact test, and otherwise the exact test still decides
+
+>>> tree = LinkedRtree(hulls=True)
+>>> ingest(tree, "http://example.org/ex3", ex3)
+>>> around = "POLYGON((-84 34, -83 34, -83 35, -84 35, -84 34))"
+>>> around = ogr.CreateGeometryFromWkt(around)
+>>> [obj["uri"] for obj in tree.contains(around)]
+[u'http://example.org/baz']
+>>> len(list(tree.contains(overlap)))
+0
+
 """
 
 from rdflib.namespace import Namespace
@@ -94,6 +183,59 @@ _tok = re.compile(r'(\s+)')
 def tok(s):
     return [x for x in _tok.split(s) if not _tok.match(x)]
 
+def _box(minx, maxx, miny, maxy):
+    wkt = "POLYGON((%r %r, %r %r, %r %r, %r %r, %r %r))" % (
+        minx, miny, maxx, miny, maxx, maxy, minx, maxy, minx, miny
+        )
+    return ogr.CreateGeometryFromWkt(wkt)
+
+def _halves(lo, hi):
+    if hi > lo:
+        mid = (lo + hi) / 2.0
+        return ((lo, mid), (mid, hi))
+    ## degenerate in this dimension, widen the clip so that
+    ## the cell is still a proper polygon
+    return ((lo - 1.0, hi + 1.0),)
+
+def _sparse(geom, envelope, extent, fill):
+    minx, maxx, miny, maxy = envelope
+    width, height = maxx - minx, maxy - miny
+    if width > extent or height > extent:
+        return True
+    area = geom.GetArea()
+    if area > 0 and area / (width * height) < fill:
+        return True
+    return False
+
+def decompose(geom, depth, extent=1.0, fill=0.5):
+    """
+    Split a geometry along a quadtree of its own envelope and return
+    the envelopes of the pieces. A piece is split further while it is
+    wider or taller than extent degrees or covers less than the fill
+    fraction of its envelope, down to the given depth.
+
+    If clipping fails, as it does for invalid geometries, the
+    envelope of the whole geometry is returned instead, so a
+    geometry is never left without an entry.
+    """
+    envelope = geom.GetEnvelope()
+    if depth <= 0 or not _sparse(geom, envelope, extent, fill):
+        return [envelope]
+    minx, maxx, miny, maxy = envelope
+    envelopes = []
+    for x0, x1 in _halves(minx, maxx):
+        for y0, y1 in _halves(miny, maxy):
+            ### OGR gives None when GEOS throws a TopologyException
+            piece = geom.Intersection(_box(x0, x1, y0, y1))
+            if piece is None:
+                return [envelope]
+            if piece.IsEmpty():
+                continue
+            envelopes.extend(decompose(piece, depth - 1, extent, fill))
+    if not envelopes:
+        return [envelope]
+    return envelopes
+
 class SpatialStore(object):
     context_aware = True
     def __init__(self, tree):
@@ -175,9 +317,30 @@ class SpatialStore(object):
             geom = ogr.CreateGeometryFromWkt(self.state["geom"])
             if geom is not None:
                 ident = hash(self.state["uri"] + self.state["graph"])
-                self.tree.delete(ident, [-180, 180, -90, 90])
-                self.tree.add(ident, geom.GetEnvelope())
+                old = self.tree.kch.get(ident)
+                if old is not None:
+                    old = json.loads(old)
+                    ### entries are only deleted on an exact match of
+                    ### the box, records from before decomposition
+                    ### have just the one, that of the geometry
+                    if "envelopes" in old:
+                        envelopes = old["envelopes"]
+                    else:
+                        envelopes = [ogr.CreateGeometryFromWkt(old["geom"]).GetEnvelope()]
+                    for envelope in envelopes:
+                        self.tree.delete(ident, envelope)
+                ## every piece goes in under the parent's identifier
+                envelopes = decompose(geom, self.tree.decompose_depth,
+                                      self.tree.decompose_extent,
+                                      self.tree.decompose_fill)
+                for envelope in envelopes:
+                    self.tree.add(ident, envelope)
+                self.state["envelopes"] = envelopes
+                if self.tree.hulls and geom.GetGeometryType() != ogr.wkbPoint:
+                    self.state["hull"] = geom.ConvexHull().ExportToWkt()
                 self.tree.kch.set(ident, json.dumps(self.state))
+                self.tree.generation += 1
+                self.tree.kch.set("generation", self.tree.generation)
 
 class QuadSink(object):
     def __init__(self, tree):
@@ -205,13 +368,30 @@ class LinkedRtree(rtree.Rtree):
     without this describe method, what gets put in the index is just
     the blank node. Which is not very much good for anything, now is
     it?
+
+    Big or sparse geometries such as countries or long routes can be
+    put in the R-tree as several pieces by giving decompose_depth,
+    the depth of the quadtree used to split them (see decompose).
+    Each piece has its own tight envelope and the identifier of the
+    whole geometry, so results are de-duplicated on the way out. With
+    hulls the convex hull is stored as well and used to accept or
+    reject candidates before the exact test on the full geometry.
+
+    The generation attribute counts the resources added so far and is
+    kept with the index, so that callers caching query results can
+    tell when they are stale, also across reopening the index.
     """
     dumps = staticmethod(json.dumps)
     loads = staticmethod(json.loads)
 
-    def __init__(self, filename=None, describe=None, **kw):
+    def __init__(self, filename=None, describe=None, decompose_depth=0,
+                 decompose_extent=1.0, decompose_fill=0.5, hulls=False, **kw):
         if describe is not None:
             self.describe = describe
+        self.decompose_depth = decompose_depth
+        self.decompose_extent = decompose_extent
+        self.decompose_fill = decompose_fill
+        self.hulls = hulls
         self.kch = kc.DB()
         kwc = kw.copy()
         kwc["interleaved"] = False
@@ -222,6 +402,8 @@ class LinkedRtree(rtree.Rtree):
             av = []
             self.kch.open("*", kc.DB.OWRITER)
         super(LinkedRtree, self).__init__(*av, **kwc)
+        generation = self.kch.get("generation")
+        self.generation = int(generation) if generation is not None else 0
 
     def close(self):
         super(LinkedRtree, self).close()
@@ -239,31 +421,68 @@ class LinkedRtree(rtree.Rtree):
         else:
             centroid = geom.Centroid()
         geom = (centroid.GetX(), centroid.GetY())
-        for obj in super(LinkedRtree, self).nearest(geom, limit):
-            data = self.kch.get(obj)
-            if data is not None:
-                yield json.loads(data)
+        ### pieces of the same geometry share an id, so ask for more
+        ### entries until there are enough distinct ones
+        seen = set()
+        found = 0
+        num_results = limit
+        while found < limit:
+            entries = 0
+            for obj in super(LinkedRtree, self).nearest(geom, num_results):
+                entries += 1
+                if obj in seen:
+                    continue
+                seen.add(obj)
+                robj = self._load(obj)
+                if robj is not None:
+                    robj.pop("hull", None)
+                    yield robj
+                    found += 1
+                    if found >= limit:
+                        return
+            if entries < num_results:
+                return
+            num_results *= 2
+
+    def _load(self, obj):
+        data = self.kch.get(obj)
+        if data is None:
+            return None
+        robj = json.loads(data)
+        robj.pop("envelopes", None)
+        return robj
+
+    def _candidates(self, geom):
+        ### sweep and prune, pieces of the same geometry share an id
+        seen = set()
+        for obj in super(LinkedRtree, self).intersection(geom.GetEnvelope()):
+            if obj in seen:
+                continue
+            seen.add(obj)
+            robj = self._load(obj)
+            if robj is None:
+                continue
+            hull = robj.pop("hull", None)
+            if hull is not None:
+                hull = ogr.CreateGeometryFromWkt(hull)
+            yield robj, hull
 
     def intersection(self, geom):
-        ### sweep and prune
-        bbox = geom.GetEnvelope()
-        for obj in super(LinkedRtree, self).intersection(bbox):
-            data = self.kch.get(obj)
-            if data is None:
+        for robj, hull in self._candidates(geom):
+            if hull is not None and not geom.Intersect(hull):
                 continue
-            robj = json.loads(data)
             rgeom = ogr.CreateGeometryFromWkt(robj["geom"])
             if geom.Intersect(rgeom):
                 yield robj
 
     def contains(self, geom):
-        ### sweep and prune
-        bbox = geom.GetEnvelope()
-        for obj in super(LinkedRtree, self).intersection(bbox):
-            data = self.kch.get(obj)
-            if data is None:
-                continue
-            robj = json.loads(data)
+        for robj, hull in self._candidates(geom):
+            if hull is not None:
+                if not geom.Intersect(hull):
+                    continue
+                if geom.Contains(hull):
+                    yield robj
+                    continue
             rgeom = ogr.CreateGeometryFromWkt(robj["geom"])
             if geom.Contains(rgeom):
                 yield robj
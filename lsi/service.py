@@ -1,9 +1,92 @@
+"""
+Indexes are opened when needed and the least recently used idle ones
+are closed once there are more than max_open
+
+>>> import tempfile, threading
+>>> from lsi import LinkedRtree
+>>> class StubNode(LinkedRtree):
+...     def __init__(self, index, **kw):
+...         super(StubNode, self).__init__()
+...         self.stopped = threading.Event()
+...     def tail(self):
+...         self.stopped.wait()
+...     def stop(self):
+...         self.stopped.set()
+...
+>>> class StubService(GeoService):
+...     def make_node(self, index, **kw):
+...         return StubNode(index, **kw)
+...
+>>> svc = StubService({"directory": tempfile.mkdtemp(), "max_open": 2})
+>>> for index in ("a", "b", "c"):
+...     _ = svc.add_index(index)
+...
+>>> list(svc.open_indexes)
+['b', 'c']
+>>> svc.release_index(svc.acquire_index("b")[0])
+>>> _ = svc.add_index("d")
+>>> list(svc.open_indexes)
+['b', 'd']
+
+An index that is being searched is not closed, even if it is the
+least recently used
+
+>>> svc = StubService({"directory": tempfile.mkdtemp(), "max_open": 1})
+>>> _ = svc.add_index("a")
+>>> state = svc.acquire_index("a")[0]
+>>> _ = svc.add_index("b")
+>>> list(svc.open_indexes)
+['a']
+>>> svc.release_index(state)
+>>> list(svc.open_indexes)
+['a']
+>>> _ = svc.add_index("b")
+>>> list(svc.open_indexes)
+['b']
+
+Searches carry an etag that changes when something is ingested, and
+a conditional request for an unchanged index gets a 304, even after
+the index has been closed
+
+>>> from werkzeug.test import Client
+>>> svc = StubService({"directory": tempfile.mkdtemp(), "max_open": 1})
+>>> _ = svc.add_index("a")
+>>> client = Client(svc, Response)
+>>> url = "/indexes/a/search?predicate=intersects&bbox=0,0,1,1"
+>>> response = client.get(url)
+>>> response.status_code, json.loads(response.data)
+(200, [])
+>>> etag = response.headers["ETag"]
+>>> client.get(url, headers={"If-None-Match": etag}).status_code
+304
+>>> quads = '''
+... <http://example.org/foo> <http://www.w3.org/2003/01/geo/wgs84_pos#lat> "0.5" <http://example.org/g> .
+... <http://example.org/foo> <http://www.w3.org/2003/01/geo/wgs84_pos#long> "0.5" <http://example.org/g> .
+... '''
+>>> svc.indexes["a"]["node"].addNQ(StringIO(quads))
+>>> response = client.get(url, headers={"If-None-Match": etag})
+>>> response.status_code, len(json.loads(response.data))
+(200, 1)
+>>> response.headers["ETag"] != etag
+True
+>>> etag = response.headers["ETag"]
+>>> _ = svc.add_index("b")
+>>> list(svc.open_indexes)
+['b']
+>>> client.get(url, headers={"If-None-Match": etag}).status_code
+304
+>>> list(svc.open_indexes)
+['b']
+"""
+
 from werkzeug.datastructures import Headers
-from werkzeug.exceptions import HTTPException, BadRequest, NotFound, NotAcceptable, InternalServerError
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound, NotAcceptable, InternalServerError, ServiceUnavailable
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Request, Response
 from autoneg.accept import negotiate
+from collections import OrderedDict
 from glob import glob
+import hashlib
 from os import path
 import traceback
 from osgeo import ogr
@@ -48,7 +131,71 @@ def tlogwrap(f, *av, **kw):
             log.error(exc)
     return _f
 
+class ResultCache(object):
+    """
+    Serialised search results keyed on their etag. Once the total
+    size goes over max_bytes the least recently used are dropped.
+
+    >>> cache = ResultCache(10)
+    >>> cache.set("a", "aaaa")
+    >>> cache.set("b", "bbbb")
+    >>> cache.get("a")
+    'aaaa'
+    >>> cache.set("c", "cccc")
+    >>> cache.get("b") is None
+    True
+    >>> list(cache.entries), cache.size
+    (['a', 'c'], 8)
+
+    Replacing an entry accounts for the size of the new one, and an
+    entry bigger than the whole cache is not stored at all
+
+    >>> cache.set("a", "aa")
+    >>> cache.size
+    6
+    >>> cache.set("d", "d" * 11)
+    >>> cache.get("d") is None
+    True
+    >>> cache.size
+    6
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.entries[key] = data
+        self.lock.release()
+        return data
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self.lock.acquire()
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+        self.lock.release()
+
 class GeoService(object):
+    """
+    Indexes found in the data directory are only registered when the
+    service starts. They are opened on first use, or straight away if
+    their configuration has "prewarm" set or a rebuild is pending.
+    When more than max_open are open the least recently used ones
+    that are neither being searched nor rebuilding are closed, which
+    also stops their tails.
+    """
     def __init__(self, config):
         self.url_map = Map([
                 Rule('/indexes', endpoint="provision"),
@@ -57,28 +204,55 @@ class GeoService(object):
                 ])
         self.config = config
         self.datadir = self.config.get("directory", "./")
+        self.max_open = self.config.get("max_open", 64)
         self.index_lock = threading.RLock()
+        self.index_changed = threading.Condition(self.index_lock)
         self.indexes = {}
+        self.open_indexes = OrderedDict()
+        self.stuck = {}
+        self.cache = ResultCache(self.config.get("cache_bytes", 64 * 1024 * 1024))
         self.start_indexes()
 
     def start_indexes(self):
         for index_file in glob(path.join(self.datadir, "*.dat")):
             index = path.basename(index_file)[:-4]
-            self.add_index(index)
+            self.register_index(index)
+            ## a pending rebuild is cleared from the config file as
+            ## soon as it is read, so it has to be started now
+            index_state = self.indexes[index]
+            if index_state["rebuild"] or index_state["config"].get("prewarm", False):
+                self.open_index(index_state)
+        self.evict_indexes()
     
     def add_index(self, index, rebuild=False):
+        index_state = self.register_index(index, rebuild)
+        self.open_index(index_state)
+        self.evict_indexes()
+        return index
+
+    def register_index(self, index, rebuild=False):
+        self.retire_index(index)
+
         self.index_lock.acquire()
 
-        index_state = self.indexes.get(index)
-        if index_state is not None:
-            del self.indexes[index]
-            index_state["node"].close()
-            t = index_state.get("tail")
-            if t is not None and t.isAlive():
-                log.info("stopping tail for %s" % index)
-                t.join()
+        idx_cfg = self.read_config(index)
+        rebuild = rebuild or idx_cfg.get("rebuild", False)
+        idx_cfg["rebuild"] = False
+        self.write_config(index, idx_cfg)
+
+        index_state = {
+            "name": index,
+            "config": idx_cfg,
+            "rebuild": rebuild,
+            "users": 0
+            }
+        self.indexes[index] = index_state
 
+        self.index_lock.release()
+
+        return index_state
 
+    def read_config(self, index):
         idx_config_file = path.join(self.datadir, index + ".cfg")
         try:
             fp = open(idx_config_file, "r")
@@ -86,14 +260,65 @@ class GeoService(object):
             fp.close()
         except IOError:
             idx_cfg = {}
+        return idx_cfg
 
-        rebuild = rebuild or idx_cfg.get("rebuild", False)
-        kw = {"rebuild": rebuild}
-        idx_cfg["rebuild"] = False
+    def write_config(self, index, idx_cfg):
+        idx_config_file = path.join(self.datadir, index + ".cfg")
         fp = open(idx_config_file, "w")
         fp.write(json.dumps(idx_cfg))
         fp.close()
 
+    def save_generation(self, index_state, node):
+        ### remember the generation of a cleanly closed index so that
+        ### searches on it can be revalidated without opening it
+        self.index_lock.acquire()
+        idx_cfg = index_state["config"]
+        idx_cfg["generation"] = node.generation
+        self.write_config(index_state["name"], idx_cfg)
+        self.index_lock.release()
+
+    def index_version(self, index):
+        ### the version of an index if it is known without opening
+        ### it, otherwise None
+        self.index_lock.acquire()
+        try:
+            index_state = self.indexes.get(index)
+            if index_state is None:
+                raise NotFound("index %s" % index)
+            if (index_state.get("opening") or index_state.get("closing") or
+                index in self.stuck):
+                return None
+            idx_cfg = index_state["config"]
+            if "node" in index_state:
+                self.open_indexes[index] = self.open_indexes.pop(index)
+                generation = index_state["node"].generation
+            else:
+                generation = idx_cfg.get("generation")
+                if generation is None:
+                    return None
+            return (idx_cfg.get("resets", 0), generation)
+        finally:
+            self.index_lock.release()
+
+    def open_index(self, index_state):
+        ### the node is made without index_lock held, so that opening
+        ### one index does not hold up searches on the others
+        self.index_lock.acquire()
+        try:
+            while index_state.get("opening") or index_state.get("closing"):
+                self.index_changed.wait()
+            index = index_state["name"]
+            if "node" in index_state:
+                self.open_indexes[index] = self.open_indexes.pop(index)
+                return index_state["node"]
+            self.check_stuck(index_state)
+            index_state["opening"] = True
+            idx_cfg = index_state["config"]
+            rebuild = index_state.get("rebuild", False)
+        finally:
+            self.index_lock.release()
+
+        kw = {"rebuild": rebuild}
         kw["username"] = self.config.get("username")
         kw["password"] = self.config.get("password")
         kw["kernel_host"] = self.config.get("kernel_host")
@@ -104,34 +329,165 @@ class GeoService(object):
                 setattr(p, k, v)
             kw["properties"] = p
 
+        for k in ("decompose_depth", "decompose_extent", "decompose_fill", "hulls"):
+            if k in idx_cfg:
+                kw[k] = idx_cfg[k]
+
         log.info("opening index on %s" % index)
 
-	# XXXX Implement GeoNode to receive data from somewhere
-        node = GeoNode(index, **kw)
+        try:
+            node = self.make_node(index, **kw)
+        except:
+            self.index_lock.acquire()
+            index_state["opening"] = False
+            self.index_changed.notify_all()
+            self.index_lock.release()
+            raise
 
-        self.indexes[index] = {
-            "node": node,
-            "config": idx_cfg
-            }
+        self.index_lock.acquire()
+        try:
+            ## the rebuild only happens the first time the index is opened
+            index_state.pop("rebuild", None)
+
+            index_state["node"] = node
+            index_state["rebuilding"] = rebuild
+            self.open_indexes[index] = index_state
+
+            ### the generation in the config file is only good while
+            ### the index is closed, it is written again on closing
+            if idx_cfg.pop("generation", None) is not None:
+                self.write_config(index, idx_cfg)
+
+            if rebuild or idx_cfg.get("tail", True):
+                log.info("starting tail for %s" % index)
+                t = threading.Thread(target=tlogwrap(node.tail), name=index)
+                t.daemon = True
+                index_state["tail"] = t
+                t.start()
+        finally:
+            index_state["opening"] = False
+            self.index_changed.notify_all()
+            self.index_lock.release()
+
+        return node
+
+    def make_node(self, index, **kw):
+	# XXXX Implement GeoNode to receive data from somewhere. Its
+	# tail method must return soon after its stop method is called
+        return GeoNode(index, **kw)
+
+    def check_stuck(self, index_state):
+        ### a node whose tail did not stop when it was closed may
+        ### still be writing to the files, never open them twice
+        index = index_state["name"]
+        stuck = self.stuck.get(index)
+        if stuck is None:
+            return
+        node, t = stuck
+        if t.isAlive():
+            raise ServiceUnavailable("index %s is still shutting down" % index)
+        del self.stuck[index]
+        self.save_generation(index_state, node)
+        log.info("closing index on %s" % index)
+        node.close()
+
+    def detach_index(self, index_state):
+        ### take the node out of service, called with index_lock
+        ### held. the node is shut down afterwards without the lock
+        ### by shutdown_index
+        index = index_state["name"]
+        if self.open_indexes.get(index) is index_state:
+            del self.open_indexes[index]
+        return index_state, index_state.pop("node", None), index_state.pop("tail", None)
+
+    def shutdown_index(self, index_state, node, t):
+        ### the tail writes to the node, so it has to stop before
+        ### the node can be closed
+        index = index_state["name"]
+        if t is not None and t.isAlive():
+            log.info("stopping tail for %s" % index)
+            node.stop()
+            t.join(self.config.get("tail_timeout", 30))
+            if t.isAlive():
+                log.error("tail for %s did not stop, leaving it open" % index)
+                self.index_lock.acquire()
+                self.stuck[index] = (node, t)
+                self.index_lock.release()
+                return
+        if node is not None:
+            self.save_generation(index_state, node)
+            log.info("closing index on %s" % index)
+            node.close()
+
+    def retire_index(self, index):
+        ### wait for searches on the index to finish, then take it
+        ### out of service and shut it down
+        self.index_lock.acquire()
+        index_state = self.indexes.pop(index, None)
+        if index_state is None:
+            self.index_lock.release()
+            return
+        while (index_state["users"] > 0 or index_state.get("opening") or
+               index_state.get("closing")):
+            self.index_changed.wait()
+        detached = self.detach_index(index_state)
+        self.index_lock.release()
+        self.shutdown_index(*detached)
 
-        if rebuild or idx_cfg.get("tail", True):
-            log.info("starting tail for %s" % index)
-            t = threading.Thread(target=tlogwrap(node.tail), name=index)
-            t.daemon = True
-            self.indexes[index]["tail"] = t
-            t.start()
+    def evict_indexes(self):
+        ### close idle indexes, least recently used first. an index
+        ### that is being searched or is still rebuilding stays open
+        self.index_lock.acquire()
+        excess = len(self.open_indexes) - self.max_open
+        closing = []
+        for index_state in list(self.open_indexes.values()):
+            if excess <= 0:
+                break
+            if index_state["users"] > 0:
+                continue
+            t = index_state.get("tail")
+            if index_state["rebuilding"] and t is not None and t.isAlive():
+                continue
+            index_state["closing"] = True
+            closing.append(index_state)
+            excess -= 1
+        detached = [self.detach_index(index_state) for index_state in closing]
+        self.index_lock.release()
 
+        for index_state, args in zip(closing, detached):
+            self.shutdown_index(*args)
+            self.index_lock.acquire()
+            index_state["closing"] = False
+            self.index_changed.notify_all()
+            self.index_lock.release()
+
+    def acquire_index(self, index):
+        ### the returned state is what must be given to release_index,
+        ### the index may have been replaced under the same name by then
+        self.index_lock.acquire()
+        index_state = self.indexes.get(index)
+        if index_state is None:
+            self.index_lock.release()
+            raise NotFound("index %s" % index)
+        index_state["users"] += 1
         self.index_lock.release()
+        try:
+            node = self.open_index(index_state)
+        except:
+            self.release_index(index_state)
+            raise
+        return index_state, node
 
-        return index
+    def release_index(self, index_state):
+        self.index_lock.acquire()
+        index_state["users"] -= 1
+        self.index_changed.notify_all()
+        self.index_lock.release()
+        self.evict_indexes()
 
     def reset(self, index):
-        self.index_lock.acquire()
         log.info("reset index %s" % index)
-        index_state = self.indexes.get(index)
-        if index_state is not None:
-            del self.indexes[index]
-            index_state["node"].close()
+        self.retire_index(index)
         try:
             os.unlink(path.join(self.datadir, index + ".dat"))
         except OSError as e:
@@ -145,8 +501,14 @@ class GeoService(object):
         except OSError as e:
             pass
 
+        ### the rebuilt index counts generations from zero again, so
+        ### count the resets to keep earlier etags from matching
+        idx_cfg = self.read_config(index)
+        idx_cfg["resets"] = idx_cfg.get("resets", 0) + 1
+        idx_cfg.pop("generation", None)
+        self.write_config(index, idx_cfg)
+
         self.add_index(index, rebuild=True)
-        self.index_lock.release()
 
     def dispatch(self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
@@ -197,10 +559,33 @@ class GeoService(object):
         return response
 
     def on_search(self, request, index):
-        if index not in self.indexes:
-            raise NotFound("index %s" % index)
-        node = self.indexes[index]["node"]
-
+        search = self.parse_search(request)
+
+        ### revalidations and cached results only need the version
+        ### of the index, which is known without opening it if it
+        ### was closed cleanly
+        version = self.index_version(index)
+        if version is not None:
+            etag = self.search_etag(index, version, search)
+            response = self.cached_search(request, etag, search)
+            if response is not None:
+                return response
+
+        index_state, node = self.acquire_index(index)
+        try:
+            version = (index_state["config"].get("resets", 0), node.generation)
+            etag = self.search_etag(index, version, search)
+            response = self.cached_search(request, etag, search)
+            if response is None:
+                data = self.evaluate(node, search)
+                self.cache.set(etag, data)
+                response = Response(data, mimetype=search["mime_type"])
+                self.tag_search(response, etag, search)
+            return response
+        finally:
+            self.release_index(index_state)
+
+    def parse_search(self, request):
         if "predicate" in request.args:
             predicate = request.args["predicate"]
         else:
@@ -246,39 +631,21 @@ class GeoService(object):
         if operand.GetGeometryType() == ogr.wkbPoint:
             operand = operand.Buffer(0.0001)
 
-        if predicate == "intersects":
-            results = node.intersection(operand)
-        elif predicate == "contains":
-            results = node.contains(operand)
-        elif predicate == "nearest":
-            try:
-                limit = int(request.args["limit"])
-            except:
-                limit = 10
-            results = node.nearest(operand, limit)
-
         try:
-            limit = int(request.args["limit"])
+            nearest_limit = int(request.args["limit"])
         except:
-            limit = 10
-        if limit > 1000:
-            limit = 1000
+            nearest_limit = 10
+        limit = min(nearest_limit, 1000)
 
         try:
             offset = int(request.args["offset"])
         except:
             offset = 0
 
-        if "type" in request.args or "text" in request.args:
-            results = parse_graph(results)
-        if "type" in request.args:
-            results = filter_types(results, *(URIRef(x) for x in request.args.getlist("type")))
-        if "text" in request.args:
-            results = filter_text(results, request.args["text"])
-        if "type" in request.args or "text" in request.args:
-            results = trim_graph(results)
-        results = filter_offset(results, offset)
-        results = filter_limit(results, limit)
+        types = sorted(set(request.args.getlist("type")))
+        text = request.args.get("text")
+        if text is not None:
+            text = text.lower()
 
         ancfg = (
             ("text", "turtle", ["turtle"]),
@@ -291,8 +658,8 @@ class GeoService(object):
 
         query = request.args.get("query")
         if query is None:
-            data = json.dumps(list(results))
-            response = Response(data, mimetype="application/json")
+            mime_type = "application/json"
+            format = None
         elif query == "closure":
             accept = request.headers.get("Accept", "*/*")
             candidates = list(negotiate(ancfg, accept))
@@ -300,19 +667,89 @@ class GeoService(object):
                 raise NotAcceptable()
             mime_type = candidates[0][0]
             format = candidates[0][1][0]
-            cg = ConjunctiveGraph()
-            for obj in results:
-                ### this shouldn't decode / reencode the json here!
-                json_description = json.dumps(obj["json_description"])
-                g = Graph(identifier=URIRef(obj["graph"]), store=cg.store)
-                RdfJsonParser().parse_json(obj["json_description"], g)
-            data = cg.serialize(format=format)
-            response = Response(data, mimetype=mime_type)
         else:
             raise BadRequest("no idea what kind of query that is")
 
+        return {
+            "predicate": predicate,
+            "operand": operand,
+            "nearest_limit": nearest_limit,
+            "limit": limit,
+            "offset": offset,
+            "types": types,
+            "text": text,
+            "query": query,
+            "mime_type": mime_type,
+            "format": format
+            }
+
+    def search_etag(self, index, version, search):
+        ### the version is the number of resets of the index and its
+        ### generation, which changes with every ingested resource,
+        ### so the etag changes whenever the answer might. the limit
+        ### given to nearest changes its results, but for the other
+        ### predicates only the clamped limit matters
+        if search["predicate"] == "nearest":
+            limit = search["nearest_limit"]
+        else:
+            limit = search["limit"]
+        key = (index, version, search["predicate"],
+               search["operand"].ExportToWkt(), limit, search["offset"],
+               search["types"], search["text"], search["query"],
+               search["mime_type"])
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def cached_search(self, request, etag, search):
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            data = self.cache.get(etag)
+            if data is None:
+                return None
+            response = Response(data, mimetype=search["mime_type"])
+        self.tag_search(response, etag, search)
         return response
 
+    def tag_search(self, response, etag, search):
+        response.set_etag(etag)
+        if search["query"] == "closure":
+            response.vary.add("Accept")
+
+    def evaluate(self, node, search):
+        predicate = search["predicate"]
+        operand = search["operand"]
+        limit, offset = search["limit"], search["offset"]
+        types, text = search["types"], search["text"]
+
+        if predicate == "intersects":
+            results = node.intersection(operand)
+        elif predicate == "contains":
+            results = node.contains(operand)
+        elif predicate == "nearest":
+            results = node.nearest(operand, search["nearest_limit"])
+
+        if types or text is not None:
+            results = parse_graph(results)
+        if types:
+            results = filter_types(results, *(URIRef(x) for x in types))
+        if text is not None:
+            results = filter_text(results, text)
+        if types or text is not None:
+            results = trim_graph(results)
+        results = filter_offset(results, offset)
+        results = filter_limit(results, limit)
+
+        if search["query"] is None:
+            return json.dumps(list(results))
+
+        cg = ConjunctiveGraph()
+        for obj in results:
+            ### this shouldn't decode / reencode the json here!
+            json_description = json.dumps(obj["json_description"])
+            g = Graph(identifier=URIRef(obj["graph"]), store=cg.store)
+            RdfJsonParser().parse_json(obj["json_description"], g)
+        return cg.serialize(format=search["format"])
+
 def parse_graph(iterable):
     for obj in iterable:
         g = Graph(identifier=obj["graph"])
@@ -382,6 +819,12 @@ def run_service():
                         help='file to log to (stderr)')
     parser.add_argument('--daemon', action='store_true',
                         default=False)
+    parser.add_argument('--max-open', metavar='N', type=int,
+                        help='number of indexes to keep open (64)',
+                        default=64)
+    parser.add_argument('--cache-bytes', metavar='B', type=int,
+                        help='size of the search result cache (64MB)',
+                        default=64 * 1024 * 1024)
     args = parser.parse_args()
 
     logcfg = {
@@ -393,6 +836,8 @@ def run_service():
 
     config = {
         "directory": "./",
+        "max_open": args.max_open,
+        "cache_bytes": args.cache_bytes,
         }
 
     def svc():
@@ -406,3 +851,6 @@ def run_service():
     else:
         svc()
 
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()